@@ -2044,7 +2044,11 @@ class ElectrumWindow(QMainWindow, MessageBoxMixin, PrintError):
         # else if the user scanned an offline signed tx
         # transactions are binary, but qrcode seems to return utf8...
         data = data.decode('utf8')
-        z = bitcoin.base_decode(data, length=None, base=43)
+        try:
+            z = bitcoin.base_decode(data, length=None, base=43)
+        except ValueError:
+            self.show_error(_("Unable to decode QR data"))
+            return
         data = ''.join(chr(ord(b)) for b in z).encode('hex')
         tx = self.tx_from_text(data)
         if not tx:
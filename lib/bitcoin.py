@@ -29,12 +29,19 @@ import base64
 import os
 import re
 import hmac
+import struct
 
 import version
 from util import print_error, InvalidPassword
 
 import ecdsa
-import pyaes
+
+# libsecp256k1 bindings; pure-python ecdsa remains as a fallback
+try:
+    import coincurve
+    HAS_COINCURVE = True
+except ImportError:
+    HAS_COINCURVE = False
 
 # Bitcoin network constants
 TESTNET = False
@@ -92,62 +99,73 @@ TYPE_PUBKEY  = 1
 TYPE_SCRIPT  = 2
 
 # AES encryption
-try:
-    from Cryptodome.Cipher import AES
-except:
-    AES = None
+from Cryptodome.Cipher import AES
 
 def aes_encrypt_with_iv(key, iv, data):
-    if AES:
-        padlen = 16 - (len(data) % 16)
-        if padlen == 0:
-            padlen = 16
-        data += chr(padlen) * padlen
-        e = AES.new(key, AES.MODE_CBC, iv).encrypt(data)
-        return e
-    else:
-        aes_cbc = pyaes.AESModeOfOperationCBC(key, iv=iv)
-        aes = pyaes.Encrypter(aes_cbc)
-        e = aes.feed(data) + aes.feed()  # empty aes.feed() appends pkcs padding
-        return e
+    padlen = 16 - (len(data) % 16)
+    if padlen == 0:
+        padlen = 16
+    data += chr(padlen) * padlen
+    return AES.new(key, AES.MODE_CBC, iv).encrypt(data)
 
 def aes_decrypt_with_iv(key, iv, data):
-    if AES:
-        cipher = AES.new(key, AES.MODE_CBC, iv)
-        data = cipher.decrypt(data)
-        padlen = ord(data[-1])
-        for i in data[-padlen:]:
-            if ord(i) != padlen:
-                raise InvalidPassword()
-        return data[0:-padlen]
-    else:
-        aes_cbc = pyaes.AESModeOfOperationCBC(key, iv=iv)
-        aes = pyaes.Decrypter(aes_cbc)
-        s = aes.feed(data) + aes.feed()  # empty aes.feed() strips pkcs padding
-        return s
+    cipher = AES.new(key, AES.MODE_CBC, iv)
+    data = cipher.decrypt(data)
+    padlen = ord(data[-1])
+    # validate the whole pad with one constant-time compare instead of
+    # a per-byte python loop
+    if padlen < 1 or padlen > 16 \
+            or not hmac.compare_digest(data[-padlen:], chr(padlen) * padlen):
+        raise InvalidPassword()
+    return data[0:-padlen]
+
+# os.urandom and b64decode already return bytes; bind them locally so
+# the per-call attribute lookups and bytes() copies go away
+_urandom = os.urandom
+_b64encode = base64.b64encode
+_b64decode = base64.b64decode
 
 def EncodeAES(secret, s):
-    iv = bytes(os.urandom(16))
+    iv = _urandom(16)
     ct = aes_encrypt_with_iv(secret, iv, s)
     e = iv + ct
-    return base64.b64encode(e)
+    return _b64encode(e)
 
 def DecodeAES(secret, e):
-    e = bytes(base64.b64decode(e))
+    e = _b64decode(e)
     iv, e = e[:16], e[16:]
     s = aes_decrypt_with_iv(secret, iv, e)
     return s
 
+# Opening a wallet calls pw_decode once per stored secret, with the same
+# password every time; memoize the password -> secret derivation so
+# Hash(password) runs once per wallet open instead of once per entry.
+_secret_cache = {}
+
+def _derive_secret(password):
+    secret = _secret_cache.get(password)
+    if secret is None:
+        if len(_secret_cache) >= 8:
+            _secret_cache.clear()
+        secret = Hash(password)
+        _secret_cache[password] = secret
+    return secret
+
+def clear_secret_cache():
+    _secret_cache.clear()
+
 def pw_encode(s, password):
     if password:
-        secret = Hash(password)
+        secret = _derive_secret(password)
         return EncodeAES(secret, s.encode("utf8"))
     else:
         return s
 
-def pw_decode(s, password):
-    if password is not None:
-        secret = Hash(password)
+def pw_decode(s, password, secret=None):
+    # batch callers may pass a precomputed secret to skip the derivation
+    if password is not None or secret is not None:
+        if secret is None:
+            secret = _derive_secret(password)
         try:
             d = DecodeAES(secret, s).decode("utf8")
         except Exception:
@@ -161,10 +179,24 @@ def rev_hex(s):
     return s.decode('hex')[::-1].encode('hex')
 
 
+# the serialization code only ever asks for these widths; struct packs
+# the little-endian bytes in C, skipping the hex-reverse-hex round trip
+_pack_le = {
+    1: struct.Struct('<B').pack,
+    2: struct.Struct('<H').pack,
+    4: struct.Struct('<I').pack,
+    8: struct.Struct('<Q').pack,
+}
+_pack_be_uint = struct.Struct('>I').pack
+
+
 def int_to_hex(i, length=1):
-    s = hex(i)[2:].rstrip('L')
-    s = "0"*(2*length - len(s)) + s
-    return rev_hex(s)
+    try:
+        return _pack_le[length](i).encode('hex')
+    except (KeyError, struct.error):
+        s = hex(i)[2:].rstrip('L')
+        s = "0"*(2*length - len(s)) + s
+        return rev_hex(s)
 
 
 def var_int(i):
@@ -190,23 +222,51 @@ def op_push(i):
         return '4e' + int_to_hex(i,4)
 
 
+# history refresh re-hashes the same pubkeys over and over; memoize the
+# pure hash functions in bounded dicts (cleared wholesale when full, and
+# on wallet close)
+_sha256_cache = {}
+_hash_160_cache = {}
+
 def sha256(x):
+    if len(x) <= 64:
+        h = _sha256_cache.get(x)
+        if h is None:
+            if len(_sha256_cache) >= 8192:
+                _sha256_cache.clear()
+            h = hashlib.sha256(x).digest()
+            _sha256_cache[x] = h
+        return h
     return hashlib.sha256(x).digest()
 
+sha256.cache_clear = _sha256_cache.clear
+
 
 def Hash(x):
     if type(x) is unicode: x=x.encode('utf-8')
-    return sha256(sha256(x))
+    return hashlib.sha256(hashlib.sha256(x).digest()).digest()
+
+
+def _hash256_many(inputs):
+    # double-SHA256 over a batch of items in one tight loop; cheaper than
+    # one Hash() call per item in address/xkey verification loops
+    _sha = hashlib.sha256
+    return [_sha(_sha(x).digest()).digest() for x in inputs]
 
 hash_encode = lambda x: x[::-1].encode('hex')
 hash_decode = lambda x: x.decode('hex')[::-1]
 hmac_sha_512 = lambda x,y: hmac.new(x, y, hashlib.sha512).digest()
 
+def _seed_prefix_match(digest, prefix):
+    # hex-encode only the bytes the prefix covers, not all 64
+    n = (len(prefix) + 1) // 2
+    return digest[:n].encode('hex').startswith(prefix)
+
 def is_new_seed(x, prefix=version.SEED_PREFIX):
     import mnemonic
     x = mnemonic.normalize_text(x)
-    s = hmac_sha_512("Seed version", x.encode('utf8')).encode('hex')
-    return s.startswith(prefix)
+    digest = hmac_sha_512("Seed version", x.encode('utf8'))
+    return _seed_prefix_match(digest, prefix)
 
 
 def is_old_seed(seed):
@@ -228,11 +288,15 @@ def is_old_seed(seed):
 def seed_type(x):
     if is_old_seed(x):
         return 'old'
-    elif is_new_seed(x):
+    # normalize and hash once; the seed types only differ in the prefix
+    # they expect on the same digest
+    import mnemonic
+    digest = hmac_sha_512("Seed version", mnemonic.normalize_text(x).encode('utf8'))
+    if _seed_prefix_match(digest, version.SEED_PREFIX):
         return 'standard'
-    elif TESTNET and is_new_seed(x, version.SEED_PREFIX_SW):
+    elif TESTNET and _seed_prefix_match(digest, version.SEED_PREFIX_SW):
         return 'segwit'
-    elif is_new_seed(x, version.SEED_PREFIX_2FA):
+    elif _seed_prefix_match(digest, version.SEED_PREFIX_2FA):
         return '2fa'
     return ''
 
@@ -246,16 +310,9 @@ def i2o_ECPublicKey(pubkey, compressed=False):
     # 0x00 = point at infinity, 0x02 and 0x03 = compressed, 0x04 = uncompressed
     # compressed keys: <sign> <x> where <sign> is 0x02 if y is even and 0x03 if y is odd
     if compressed:
-        if pubkey.point.y() & 1:
-            key = '03' + '%064x' % pubkey.point.x()
-        else:
-            key = '02' + '%064x' % pubkey.point.x()
-    else:
-        key = '04' + \
-              '%064x' % pubkey.point.x() + \
-              '%064x' % pubkey.point.y()
-
-    return key.decode('hex')
+        return chr(2 + (pubkey.point.y() & 1)) + ('%064x' % pubkey.point.x()).decode('hex')
+    return '\x04' + ('%064x' % pubkey.point.x()).decode('hex') \
+                  + ('%064x' % pubkey.point.y()).decode('hex')
 
 # end pywallet openssl private key implementation
 
@@ -263,14 +320,31 @@ def i2o_ECPublicKey(pubkey, compressed=False):
 
 ############ functions from pywallet #####################
 
+# pick the RIPEMD-160 constructor once at import time instead of
+# probing the environment and dispatching by name on every call
+if 'ANDROID_DATA' in os.environ:
+    from Crypto.Hash import RIPEMD
+    _ripemd160_new = RIPEMD.new
+else:
+    try:
+        hashlib.new('ripemd')
+        _ripemd160_new = lambda data='': hashlib.new('ripemd', data)
+    except ValueError:
+        # OpenSSL builds without legacy ripemd; Cryptodome is a hard
+        # dependency and ships its own implementation
+        from Cryptodome.Hash import RIPEMD160
+        _ripemd160_new = RIPEMD160.new
+
 def hash_160(public_key):
-    if 'ANDROID_DATA' in os.environ:
-        from Crypto.Hash import RIPEMD
-        md = RIPEMD.new()
-    else:
-        md = hashlib.new('ripemd')
-    md.update(sha256(public_key))
-    return md.digest()
+    h = _hash_160_cache.get(public_key)
+    if h is None:
+        h = _ripemd160_new(sha256(public_key)).digest()
+        if len(_hash_160_cache) >= 8192:
+            _hash_160_cache.clear()
+        _hash_160_cache[public_key] = h
+    return h
+
+hash_160.cache_clear = _hash_160_cache.clear
 
 def hash_160_to_bc_address(h160, addrtype, witness_program_version=1):
     s = chr(addrtype)
@@ -304,6 +378,17 @@ assert len(__b58chars) == 58
 __b43chars = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ$*+-./:'
 assert len(__b43chars) == 43
 
+def _base_decode_table(chars):
+    # 256-entry digit lookup table; 0xFF marks characters outside the
+    # alphabet
+    table = [0xFF] * 256
+    for i, c in enumerate(chars):
+        table[ord(c)] = i
+    return table
+
+__b58chars_inv = _base_decode_table(__b58chars)
+__b43chars_inv = _base_decode_table(__b43chars)
+
 
 def base_encode(v, base):
     """ encode v, which is a string of bytes, to base58."""
@@ -311,9 +396,9 @@ def base_encode(v, base):
         chars = __b58chars
     elif base == 43:
         chars = __b43chars
-    long_value = 0L
-    for (i, c) in enumerate(v[::-1]):
-        long_value += (256**i) * ord(c)
+    # int() parses the whole string in C; much faster than a Python
+    # loop accumulating 256**i terms
+    long_value = int(v.encode('hex'), 16) if v else 0L
     result = ''
     while long_value >= base:
         div, mod = divmod(long_value, base)
@@ -333,17 +418,24 @@ def base_decode(v, length, base):
     """ decode v into a string of len bytes."""
     if base == 58:
         chars = __b58chars
+        lut = __b58chars_inv
     elif base == 43:
         chars = __b43chars
+        lut = __b43chars_inv
     long_value = 0L
-    for (i, c) in enumerate(v[::-1]):
-        long_value += chars.find(c) * (base**i)
-    result = ''
-    while long_value >= 256:
-        div, mod = divmod(long_value, 256)
-        result = chr(mod) + result
-        long_value = div
-    result = chr(long_value) + result
+    for c in v:
+        # Horner form: one multiply-add per digit instead of base**i,
+        # with an O(1) table lookup instead of chars.find; GUI callers
+        # pass unicode, so ordinals beyond the table are invalid too
+        o = ord(c)
+        d = lut[o] if o < 256 else 0xFF
+        if d == 0xFF:
+            raise ValueError('invalid characters in base%d string' % base)
+        long_value = long_value * base + d
+    s = '%x' % long_value
+    if len(s) % 2:
+        s = '0' + s
+    result = s.decode('hex')
     nPad = 0
     for c in v:
         if c == chars[0]: nPad += 1
@@ -355,20 +447,16 @@ def base_decode(v, length, base):
 
 
 def EncodeBase58Check(vchIn):
-    hash = Hash(vchIn)
-    return base_encode(vchIn + hash[0:4], base=58)
+    return base_encode(vchIn + Hash(vchIn)[0:4], base=58)
 
 
 def DecodeBase58Check(psz):
     vchRet = base_decode(psz, None, base=58)
-    key = vchRet[0:-4]
-    csum = vchRet[-4:]
-    hash = Hash(key)
-    cs32 = hash[0:4]
-    if cs32 != csum:
+    key = vchRet[:-4]
+    h = hashlib.sha256(hashlib.sha256(key).digest()).digest()
+    if not hmac.compare_digest(h[0:4], vchRet[-4:]):
         return None
-    else:
-        return key
+    return key
 
 
 def PrivKeyToSecret(privkey):
@@ -440,6 +528,27 @@ def is_address(addr):
         return False
     return addr == hash_160_to_bc_address(h, addrtype)
 
+def verify_addresses(addrs):
+    """Batch variant of is_address: decode all payloads first, then run
+    the checksum double-SHA256 in one tight loop instead of a full
+    decode/re-encode round trip per address."""
+    payloads = []
+    for addr in addrs:
+        try:
+            payloads.append(base_decode(addr, 25, base=58))
+        except (ValueError, TypeError):
+            payloads.append(None)
+    hashes = iter(_hash256_many([b[:-4] for b in payloads if b is not None]))
+    result = []
+    for b in payloads:
+        if b is None:
+            result.append(False)
+            continue
+        ok = b[-4:] == next(hashes)[0:4] \
+            and ord(b[0]) in [ADDRTYPE_P2PKH, ADDRTYPE_P2SH]
+        result.append(ok)
+    return result
+
 def is_p2pkh(addr):
     if is_address(addr):
         addrtype, h = bc_address_to_hash_160(addr)
@@ -478,6 +587,16 @@ from ecdsa.curves import SECP256k1
 from ecdsa.ellipticcurve import Point
 from ecdsa.util import string_to_number, number_to_string
 
+# GMP does 256-bit modular exponentiation/inversion in C; fall back to
+# the pure-python routines when gmpy2 is not installed
+try:
+    import gmpy2
+    _powmod = gmpy2.powmod
+    _invmod = lambda a, m: int(gmpy2.invert(a, m))
+except ImportError:
+    from ecdsa.numbertheory import inverse_mod as _invmod
+    _powmod = pow
+
 def msg_magic(message):
     varint = var_int(len(message))
     encoded_varint = "".join([chr(int(varint[i:i+2], 16)) for i in xrange(0, len(varint), 2)])
@@ -491,7 +610,7 @@ def verify_message(address, sig, message):
         # check public key using the address
         pubkey = point_to_ser(public_key.pubkey.point, compressed)
         addr = public_key_to_p2pkh(pubkey)
-        if address != addr:
+        if not hmac.compare_digest(str(address), str(addr)):
             raise Exception("Bad signature")
         # check message
         public_key.verify_digest(sig[1:], h, sigdecode = ecdsa.util.sigdecode_string)
@@ -506,17 +625,29 @@ def encrypt_message(message, pubkey):
 
 
 def chunks(l, n):
-    return [l[i:i+n] for i in xrange(0, len(l), n)]
+    # generator of n-sized pieces; byte strings are sliced through a
+    # memoryview so no per-chunk copies are made
+    mv = memoryview(l) if isinstance(l, (bytes, bytearray)) else l
+    for i in xrange(0, len(mv), n):
+        yield mv[i:i+n]
 
 
 def ECC_YfromX(x,curved=curve_secp256k1, odd=True):
     _p = curved.p()
     _a = curved.a()
     _b = curved.b()
+    # secp256k1's p is 3 mod 4, so for an on-curve x the square root is
+    # a single exponentiation; squaring the candidate verifies curve
+    # membership without a second exponentiation
+    if _p % 4 == 3:
+        alpha = (_powmod(x, 3, _p) + _a * x + _b) % _p
+        beta = int(_powmod(alpha, (_p+1)/4, _p))
+        if beta * beta % _p == alpha:
+            return [beta if odd == bool(beta&1) else _p - beta, 0]
     for offset in range(128):
         Mx = x + offset
-        My2 = pow(Mx, 3, _p) + _a * pow(Mx, 2, _p) + _b % _p
-        My = pow(My2, (_p+1)/4, _p )
+        My2 = _powmod(Mx, 3, _p) + _a * _powmod(Mx, 2, _p) + _b % _p
+        My = int(_powmod(My2, (_p+1)/4, _p ))
 
         if curved.contains_point(Mx,My):
             if odd == bool(My&1):
@@ -530,9 +661,10 @@ def negative_point(P):
 
 
 def point_to_ser(P, comp=True ):
+    x = ('%064x' % P.x()).decode('hex')
     if comp:
-        return ( ('%02x'%(2+(P.y()&1)))+('%064x'%P.x()) ).decode('hex')
-    return ( '04'+('%064x'%P.x())+('%064x'%P.y()) ).decode('hex')
+        return chr(2 + (P.y()&1)) + x
+    return '\x04' + x + ('%064x' % P.y()).decode('hex')
 
 
 def ser_to_point(Aser):
@@ -546,18 +678,60 @@ def ser_to_point(Aser):
     return Point( curve, Mx, ECC_YfromX(Mx, curve, Aser[0]=='\x03')[0], _r )
 
 
+# Fixed-base multiplication for the pure-python fallback: the generator
+# never changes, so precompute table[j][d] = (d << 4*j) * G for 4-bit
+# windows. A scalar mult then costs at most 63 point additions instead
+# of ~256 doublings plus ~128 additions in ecdsa's double-and-add.
+# Built lazily on first use (~1k point ops) and kept for the process
+# lifetime.
+_comb_table = None
+
+def _fixed_base_table():
+    global _comb_table
+    if _comb_table is None:
+        table = []
+        base = generator_secp256k1
+        for j in range(64):
+            row = [None, base]
+            acc = base
+            for d in range(2, 16):
+                acc = acc + base
+                row.append(acc)
+            table.append(row)
+            base = base.double().double().double().double()
+        _comb_table = table
+    return _comb_table
+
+def _fixed_base_mul(k):
+    from ecdsa.ellipticcurve import INFINITY
+    k = k % generator_secp256k1.order()
+    table = _fixed_base_table()
+    acc = INFINITY
+    for j in range(64):
+        d = (k >> (4*j)) & 0xF
+        if d:
+            acc = acc + table[j][d]
+    return acc
+
+
 
 class MyVerifyingKey(ecdsa.VerifyingKey):
     @classmethod
     def from_signature(klass, sig, recid, h, curve):
         """ See http://www.secg.org/download/aid-780/sec1-v2.pdf, chapter 4.1.6 """
-        from ecdsa import util, numbertheory
+        from ecdsa import util
         import msqr
         curveFp = curve.curve
         G = curve.generator
         order = G.order()
         # extract r,s from signature
         r, s = util.sigdecode_string(sig, order)
+        if HAS_COINCURVE:
+            # libsecp does the whole recovery in C
+            pub = coincurve.PublicKey.from_signature_and_message(
+                sig + chr(recid), h, hasher=None)
+            x, y = pub.point()
+            return klass.from_public_point(Point(curveFp, x, y, order), curve)
         # 1.1
         x = r + (recid/2) * order
         # 1.3
@@ -570,7 +744,7 @@ class MyVerifyingKey(ecdsa.VerifyingKey):
         e = string_to_number(h)
         minus_e = -e % order
         # 1.6 compute Q = r^-1 (sR - eG)
-        inv_r = numbertheory.inverse_mod(r,order)
+        inv_r = _invmod(r, order)
         Q = inv_r * ( s * R + minus_e * G )
         return klass.from_public_point( Q, curve )
 
@@ -607,7 +781,12 @@ class EC_KEY(object):
 
     def __init__( self, k ):
         secret = string_to_number(k)
-        self.pubkey = ecdsa.ecdsa.Public_key( generator_secp256k1, generator_secp256k1 * secret )
+        if HAS_COINCURVE:
+            x, y = coincurve.PublicKey.from_valid_secret(k).point()
+            point = Point( curve_secp256k1, x, y, generator_secp256k1.order() )
+        else:
+            point = _fixed_base_mul(secret)
+        self.pubkey = ecdsa.ecdsa.Public_key( generator_secp256k1, point )
         self.privkey = ecdsa.ecdsa.Private_key( self.pubkey, secret )
         self.secret = secret
 
@@ -622,11 +801,13 @@ class EC_KEY(object):
         return signature
 
     def sign_message(self, message, is_compressed):
-        signature = self.sign(Hash(msg_magic(message)))
+        # hash the message once; the recovery loop below reuses it
+        h = Hash(msg_magic(message))
+        signature = self.sign(h)
         for i in range(4):
             sig = chr(27 + i + (4 if is_compressed else 0)) + signature
             try:
-                self.verify_message(sig, message)
+                self.verify_message(sig, message, h=h)
                 return sig
             except Exception:
                 continue
@@ -634,8 +815,9 @@ class EC_KEY(object):
             raise Exception("error: cannot sign message")
 
 
-    def verify_message(self, sig, message):
-        h = Hash(msg_magic(message))
+    def verify_message(self, sig, message, h=None):
+        if h is None:
+            h = Hash(msg_magic(message))
         public_key, compressed = pubkey_from_signature(sig, h)
         # check public key
         if point_to_ser(public_key.pubkey.point, compressed) != point_to_ser(self.pubkey.point, compressed):
@@ -649,13 +831,20 @@ class EC_KEY(object):
     @classmethod
     def encrypt_message(self, message, pubkey):
 
-        pk = ser_to_point(pubkey)
-        if not ecdsa.ecdsa.point_is_valid(generator_secp256k1, pk.x(), pk.y()):
-            raise Exception('invalid pubkey')
-
         ephemeral_exponent = number_to_string(ecdsa.util.randrange(pow(2,256)), generator_secp256k1.order())
         ephemeral = EC_KEY(ephemeral_exponent)
-        ecdh_key = point_to_ser(pk * ephemeral.privkey.secret_multiplier)
+        if HAS_COINCURVE:
+            # libsecp validates the point and does the ECDH multiply in C
+            try:
+                pk = coincurve.PublicKey(pubkey)
+            except Exception:
+                raise Exception('invalid pubkey')
+            ecdh_key = pk.multiply(ephemeral_exponent).format(compressed=True)
+        else:
+            pk = ser_to_point(pubkey)
+            if not ecdsa.ecdsa.point_is_valid(generator_secp256k1, pk.x(), pk.y()):
+                raise Exception('invalid pubkey')
+            ecdh_key = point_to_ser(pk * ephemeral.privkey.secret_multiplier)
         key = hashlib.sha512(ecdh_key).digest()
         iv, key_e, key_m = key[0:16], key[16:32], key[32:]
         ciphertext = aes_encrypt_with_iv(key_e, iv, message)
@@ -676,16 +865,24 @@ class EC_KEY(object):
         mac = encrypted[-32:]
         if magic != 'BIE1':
             raise Exception('invalid ciphertext: invalid magic bytes')
-        try:
-            ephemeral_pubkey = ser_to_point(ephemeral_pubkey)
-        except AssertionError, e:
-            raise Exception('invalid ciphertext: invalid ephemeral pubkey')
-        if not ecdsa.ecdsa.point_is_valid(generator_secp256k1, ephemeral_pubkey.x(), ephemeral_pubkey.y()):
-            raise Exception('invalid ciphertext: invalid ephemeral pubkey')
-        ecdh_key = point_to_ser(ephemeral_pubkey * self.privkey.secret_multiplier)
+        if HAS_COINCURVE:
+            try:
+                pk = coincurve.PublicKey(ephemeral_pubkey)
+            except Exception:
+                raise Exception('invalid ciphertext: invalid ephemeral pubkey')
+            secret_bytes = number_to_string(self.secret, generator_secp256k1.order())
+            ecdh_key = pk.multiply(secret_bytes).format(compressed=True)
+        else:
+            try:
+                ephemeral_pubkey = ser_to_point(ephemeral_pubkey)
+            except AssertionError, e:
+                raise Exception('invalid ciphertext: invalid ephemeral pubkey')
+            if not ecdsa.ecdsa.point_is_valid(generator_secp256k1, ephemeral_pubkey.x(), ephemeral_pubkey.y()):
+                raise Exception('invalid ciphertext: invalid ephemeral pubkey')
+            ecdh_key = point_to_ser(ephemeral_pubkey * self.privkey.secret_multiplier)
         key = hashlib.sha512(ecdh_key).digest()
         iv, key_e, key_m = key[0:16], key[16:32], key[32:]
-        if mac != hmac.new(key_m, encrypted[:-32], hashlib.sha256).digest():
+        if not hmac.compare_digest(mac, hmac.new(key_m, encrypted[:-32], hashlib.sha256).digest()):
             raise InvalidPassword()
         return aes_decrypt_with_iv(key_e, iv, ciphertext)
 
@@ -694,12 +891,24 @@ class EC_KEY(object):
 
 random_seed = lambda n: "%032x"%ecdsa.util.randrange( pow(2,n) )
 BIP32_PRIME = 0x80000000
+_CURVE_ORDER = generator_secp256k1.order()
+
+# int() and the %x formatter run in C; ecdsa's string_to_number/
+# number_to_string go through the interpreter byte by byte
+def _string_to_number(s):
+    return int(s.encode('hex'), 16)
+
+def _number_to_string_32(n):
+    return ('%064x' % n).decode('hex')
 
 
 def get_pubkeys_from_secret(secret):
     # public key
-    private_key = ecdsa.SigningKey.from_string( secret, curve = SECP256k1 )
-    public_key = private_key.get_verifying_key()
+    if HAS_COINCURVE:
+        pub = coincurve.PublicKey.from_valid_secret(secret)
+        return pub.format(compressed=False)[1:], pub.format(compressed=True)
+    point = _fixed_base_mul(string_to_number(secret))
+    public_key = ecdsa.VerifyingKey.from_public_point( point, curve = SECP256k1 )
     K = public_key.to_string()
     K_compressed = GetPubKey(public_key.pubkey,True)
     return K, K_compressed
@@ -715,15 +924,17 @@ def get_pubkeys_from_secret(secret):
 #  public key can be determined without the master private key.
 def CKD_priv(k, c, n):
     is_prime = n & BIP32_PRIME
-    return _CKD_priv(k, c, rev_hex(int_to_hex(n,4)).decode('hex'), is_prime)
+    return _CKD_priv(k, c, _pack_be_uint(n), is_prime)
 
 def _CKD_priv(k, c, s, is_prime):
-    order = generator_secp256k1.order()
-    keypair = EC_KEY(k)
-    cK = GetPubKey(keypair.pubkey,True)
-    data = chr(0) + k + s if is_prime else cK + s
+    if is_prime:
+        data = chr(0) + k + s
+    elif HAS_COINCURVE:
+        data = coincurve.PublicKey.from_valid_secret(k).format(compressed=True) + s
+    else:
+        data = GetPubKey(EC_KEY(k).pubkey,True) + s
     I = hmac.new(c, data, hashlib.sha512).digest()
-    k_n = number_to_string( (string_to_number(I[0:32]) + string_to_number(k)) % order , order )
+    k_n = _number_to_string_32( (_string_to_number(I[0:32]) + _string_to_number(k)) % _CURVE_ORDER )
     c_n = I[32:]
     return k_n, c_n
 
@@ -735,25 +946,27 @@ def _CKD_priv(k, c, s, is_prime):
 #  non-negative. If n is negative, we need the master private key to find it.
 def CKD_pub(cK, c, n):
     if n & BIP32_PRIME: raise
-    return _CKD_pub(cK, c, rev_hex(int_to_hex(n,4)).decode('hex'))
+    return _CKD_pub(cK, c, _pack_be_uint(n))
 
 # helper function, callable with arbitrary string
 def _CKD_pub(cK, c, s):
-    order = generator_secp256k1.order()
     I = hmac.new(c, cK + s, hashlib.sha512).digest()
-    curve = SECP256k1
-    pubkey_point = string_to_number(I[0:32])*curve.generator + ser_to_point(cK)
-    public_key = ecdsa.VerifyingKey.from_public_point( pubkey_point, curve = SECP256k1 )
     c_n = I[32:]
+    if HAS_COINCURVE:
+        # ec_pubkey_tweak_add computes I[0:32]*G + point(cK) in libsecp
+        cK_n = coincurve.PublicKey(cK).add(I[0:32]).format(compressed=True)
+        return cK_n, c_n
+    pubkey_point = _fixed_base_mul(string_to_number(I[0:32])) + ser_to_point(cK)
+    public_key = ecdsa.VerifyingKey.from_public_point( pubkey_point, curve = SECP256k1 )
     cK_n = GetPubKey(public_key.pubkey,True)
     return cK_n, c_n
 
 
 def xprv_header(xtype):
-    return ("%08x"%(XPRV_HEADER + xtype)).decode('hex')
+    return _pack_be_uint(XPRV_HEADER + xtype)
 
 def xpub_header(xtype):
-    return ("%08x"%(XPUB_HEADER + xtype)).decode('hex')
+    return _pack_be_uint(XPUB_HEADER + xtype)
 
 def serialize_xprv(xtype, c, k, depth=0, fingerprint=chr(0)*4, child_number=chr(0)*4):
     xprv = xprv_header(xtype) + chr(depth) + fingerprint + child_number + c + chr(0) + k
@@ -849,7 +1062,7 @@ def bip32_private_derivation(xprv, branch, sequence):
         depth += 1
     _, parent_cK = get_pubkeys_from_secret(parent_k)
     fingerprint = hash_160(parent_cK)[0:4]
-    child_number = ("%08X"%i).decode('hex')
+    child_number = _pack_be_uint(i)
     K, cK = get_pubkeys_from_secret(k)
     xpub = serialize_xpub(xtype, c, cK, depth, fingerprint, child_number)
     xprv = serialize_xprv(xtype, c, k, depth, fingerprint, child_number)
@@ -867,7 +1080,7 @@ def bip32_public_derivation(xpub, branch, sequence):
         cK, c = CKD_pub(cK, c, i)
         depth += 1
     fingerprint = hash_160(parent_cK)[0:4]
-    child_number = ("%08X"%i).decode('hex')
+    child_number = _pack_be_uint(i)
     return serialize_xpub(xtype, c, cK, depth, fingerprint, child_number)
 
 
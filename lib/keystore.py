@@ -631,7 +631,7 @@ def is_old_mpk(mpk):
 
 def is_address_list(text):
     parts = text.split()
-    return bool(parts) and all(bitcoin.is_address(x) for x in parts)
+    return bool(parts) and all(bitcoin.verify_addresses(parts))
 
 def get_private_keys(text):
     parts = text.split('\n')
@@ -1,3 +1,4 @@
+# -*- coding: utf-8 -*-
 import unittest
 import sys
 from ecdsa.util import number_to_string
@@ -7,7 +8,7 @@ from lib.bitcoin import (
     bip32_root, bip32_public_derivation, bip32_private_derivation, pw_encode,
     pw_decode, Hash, public_key_from_private_key, address_from_private_key,
     is_valid, is_private_key, xpub_from_xprv, is_new_seed, is_old_seed,
-    var_int, op_push)
+    var_int, op_push, is_address, verify_addresses)
 
 try:
     import ecdsa
@@ -170,6 +171,20 @@ class Test_keyImport(unittest.TestCase):
         self.assertTrue(is_valid(self.main_address))
         self.assertFalse(is_valid("not an address"))
 
+    def test_verify_addresses(self):
+        addresses = [
+            self.main_address,
+            "3P14159f73E4gFr7JterCCQh9QjiTjiZrG",          # p2sh
+            "15mKKb2eos1hWa6tisdPwwDC1a5J1y9nmA",          # bad checksum
+            "not an address",
+            u'привет',       # non-latin-1
+            "",
+        ]
+        self.assertEqual(verify_addresses(addresses),
+                         [is_address(addr) for addr in addresses])
+        self.assertEqual(verify_addresses(addresses),
+                         [True, True, False, False, False, False])
+
     def test_is_private_key(self):
         self.assertTrue(is_private_key(self.private_key))
         self.assertFalse(is_private_key(self.public_key_hex))
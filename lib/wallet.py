@@ -973,6 +973,9 @@ class Abstract_Wallet(PrintError):
             # remain so they will be GC-ed
             self.storage.put('stored_height', self.get_local_height())
         self.save_transactions()
+        clear_secret_cache()
+        hash_160.cache_clear()
+        sha256.cache_clear()
         self.storage.put('verified_tx3', self.verified_tx)
         self.storage.write()
 
@@ -1615,6 +1618,7 @@ class Simple_Deterministic_Wallet(Deterministic_Wallet, Simple_Wallet):
         self.save_keystore()
         self.storage.set_password(new_pw, encrypt)
         self.storage.write()
+        clear_secret_cache()
 
     def save_keystore(self):
         self.storage.put('keystore', self.keystore.dump())
@@ -1723,6 +1727,7 @@ class Multisig_Wallet(Deterministic_Wallet, P2SH):
                 self.storage.put(name, keystore.dump())
         self.storage.set_password(new_pw, encrypt)
         self.storage.write()
+        clear_secret_cache()
 
     def check_password(self, password):
         self.keystore.check_password(password)
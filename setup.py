@@ -36,7 +36,7 @@ setup(
     name="Electrum",
     version=version.ELECTRUM_VERSION,
     install_requires=[
-        'pyaes',
+        'pycryptodomex',
         'ecdsa>=0.9',
         'pbkdf2',
         'requests',